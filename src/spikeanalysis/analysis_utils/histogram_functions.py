@@ -1,5 +1,5 @@
 import numpy as np
-from numba import jit
+from numba import jit, prange
 import numba
 
 
@@ -20,6 +20,140 @@ def spike_times_to_bins(
     return bin_array, bin_centers
 
 
+@jit(nopython=True, cache=True)
+def spike_times_to_unit_bins(
+    time_stamps: np.array,
+    unit_index: np.array,
+    n_units: int,
+    events: np.array,
+    bin_size: np.int64,
+    start: np.int64,
+    end: np.int64,
+) -> tuple[np.array, np.array]:
+    """Bins the spikes of all units around each event at once. Gives the same bins as calling
+    spike_times_to_bins for each unit, but the time_stamps must be sorted and unit_index gives the
+    row of each spike in the (n_units, n_events, n_bins) output with -1 for spikes to ignore"""
+    step_number = int(abs((end - start) / bin_size) + 1)
+    bin_borders = np.linspace(start, end, step_number)
+    bin_centers = bin_borders[:-1] + np.diff(bin_borders) / 2
+
+    # a stable sort keeps each unit's spikes in time order. Units are consecutive integers so one
+    # search gives every boundary with unit u running from unit_bounds[u] to unit_bounds[u + 1]
+    order = np.argsort(unit_index, kind="mergesort")
+    unit_bounds = np.searchsorted(unit_index[order], np.arange(n_units + 1), side="left")
+    bin_array = _bin_units(time_stamps[order], unit_bounds[:-1], unit_bounds[1:], events, bin_borders)
+
+    return bin_array, bin_centers
+
+
+# kept apart from spike_times_to_unit_bins so the borders come from the same serial linspace as spike_times_to_bins
+@jit(nopython=True, parallel=True, cache=True)
+def _bin_units(
+    time_stamps: np.array, unit_starts: np.array, unit_stops: np.array, events: np.array, bin_borders: np.array
+) -> np.array:
+    bin_number = len(bin_borders) - 1
+    bin_width = (bin_borders[-1] - bin_borders[0]) / bin_number
+    bin_array = np.zeros((len(unit_starts), len(events), bin_number), np.int32)
+    start = bin_borders[0]
+    end = bin_borders[-1]
+
+    for unit in prange(len(unit_starts)):
+        unit_times = time_stamps[unit_starts[unit] : unit_stops[unit]]
+        first_spikes = np.searchsorted(unit_times, events + start, side="left")
+        last_spikes = np.searchsorted(unit_times, events + end, side="right")
+        for n in range(len(events)):
+            for spike in range(first_spikes[n], last_spikes[n]):
+                relative_time = unit_times[spike] - events[n]
+                # guess the bin then step to the right linspace border, like np.histogram the last bin includes the end
+                bin_index = min(max(int((relative_time - start) / bin_width), 0), bin_number - 1)
+                while bin_index > 0 and relative_time < bin_borders[bin_index]:
+                    bin_index -= 1
+                while bin_index < bin_number - 1 and relative_time >= bin_borders[bin_index + 1]:
+                    bin_index += 1
+                bin_array[unit, n, bin_index] += 1
+
+    return bin_array
+
+
+@jit(nopython=True, cache=True)
+def spike_times_to_acg(
+    time_stamps: np.array, unit_index: np.array, n_units: int, bin_borders: np.array
+) -> tuple[np.array, np.array]:
+    """Autocorrelogram counts of all units at once. Gives the same counts as histdiff of each unit's
+    spikes against themselves for integer time_stamps and positive bin_borders, but the time_stamps must
+    be sorted and unit_index gives the row of each spike in the (n_units, n_bins) output with -1 for
+    spikes to ignore"""
+    bin_centers = bin_borders[:-1] + np.diff(bin_borders) / 2
+
+    # the lag between two integer time stamps is an integer so a lookup table maps every lag that can
+    # land in the acg straight to its bin, -1 for lags before the first border
+    lags = np.arange(int(np.ceil(bin_borders[-1])))
+    lag_bins = np.searchsorted(bin_borders, lags, side="right") - 1
+
+    order = np.argsort(unit_index, kind="mergesort")
+    unit_bounds = np.searchsorted(unit_index[order], np.arange(n_units + 1), side="left")
+    acg = _acg_units(
+        time_stamps[order].astype(np.int64), unit_bounds[:-1], unit_bounds[1:], lag_bins, len(bin_borders) - 1
+    )
+
+    return acg, bin_centers
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _acg_units(
+    time_stamps: np.array, unit_starts: np.array, unit_stops: np.array, lag_bins: np.array, bin_number: int
+) -> np.array:
+    max_lag = len(lag_bins)
+    acg = np.zeros((len(unit_starts), bin_number), np.int32)
+
+    for unit in prange(len(unit_starts)):
+        for spike in range(unit_starts[unit], unit_stops[unit]):
+            # the spikes are sorted so the sweep stops at the first lag past the last border
+            for later_spike in range(spike + 1, unit_stops[unit]):
+                lag = time_stamps[later_spike] - time_stamps[spike]
+                if lag >= max_lag:
+                    break
+                if lag_bins[lag] >= 0:
+                    acg[unit, lag_bins[lag]] += 1
+
+    return acg
+
+
+def acg_fft(time_stamps: np.array, bin_borders: np.array) -> tuple[np.array, np.array]:
+    """Autocorrelogram counts of one unit from the fft of its spike train. Gives the same counts as
+    spike_times_to_acg, but the cost follows the length of the recording instead of the number of
+    spike pairs so it only pays off for very dense units"""
+    bin_centers = bin_borders[:-1] + np.diff(bin_borders) / 2
+    lags = np.arange(int(np.ceil(bin_borders[-1])))
+    lag_bins = np.searchsorted(bin_borders, lags, side="right") - 1
+    if len(time_stamps) == 0:
+        return np.zeros(len(bin_borders) - 1, dtype=np.int32), bin_centers
+
+    # autocorrelation of the per sample spike train gives the number of spike pairs at every integer lag.
+    # padding by the longest lag keeps the circular correlation from wrapping into the lags we keep
+    spike_train = np.bincount((time_stamps - np.min(time_stamps)).astype(np.int64))
+    n_fft = len(spike_train) + len(lags)
+    spectrum = np.fft.rfft(spike_train, n_fft)
+    lag_counts = np.rint(np.fft.irfft(spectrum * np.conj(spectrum), n_fft)[: len(lags)])
+
+    # lag 0 pairs every spike with itself and always falls before the first positive border
+    kept = lag_bins >= 0
+    counts = np.bincount(lag_bins[kept], weights=lag_counts[kept], minlength=len(bin_borders) - 1)
+
+    return counts.astype(np.int32), bin_centers
+
+
+def window_indices(time_stamps: np.array, starts: np.array, stops: np.array) -> tuple[np.array, np.array]:
+    """Finds the sorted time_stamps strictly inside each (start, stop) window. Returns the window
+    index and the time stamp index of every match, ordered by window and then by time"""
+    first_stamp = np.searchsorted(time_stamps, starts, side="right")
+    last_stamp = np.searchsorted(time_stamps, stops, side="left")
+    n_stamps = np.maximum(last_stamp - first_stamp, 0)
+    window_index = np.repeat(np.arange(len(starts)), n_stamps)
+    stamp_index = np.arange(np.sum(n_stamps)) - np.repeat(np.cumsum(n_stamps) - n_stamps - first_stamp, n_stamps)
+    return window_index, stamp_index
+
+
 def rasterize(time_stamps: np.array) -> tuple[np.array, np.array]:
     x_out = np.empty((len(time_stamps) * 3))
     x_out[:] = np.NaN
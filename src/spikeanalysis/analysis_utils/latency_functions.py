@@ -1,10 +1,94 @@
 import numpy as np
-from numba import jit
+from numba import jit, prange, guvectorize
 import math
 
+# fastmath without the no-nan/no-inf assumptions since nan marks trials without a latency
+# and a log survival of -inf is a valid result
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
-@jit(nopython=True)
-def latency_core_stats(bsl_fr: float, firing_data: np.array, time_bin_size: float) -> np.ndarray:
+###############################################################################
+# Helper Functions for doing Poisson
+###############################################################################
+
+
+@jit("float64(int64, float64, float64)", nopython=True, nogil=True, cache=True, fastmath=FASTMATH, inline="always")
+def poisson_logsf(k: int, mu: float, log_mu: float) -> float:
+    """log of the survival function (1 - cdf) which stays accurate for tiny survivals and
+    large mu. The tail beyond k is summed relative to its first term when k is above mu
+    otherwise the cdf is summed relative to its last term and subtracted from 1
+    Parameters
+    ----------
+    k: int
+        The value to calculate the survival function for
+    mu: float
+        the mu of the poisson distribution
+    log_mu: float
+        log(mu) precomputed by the caller since many k are tested for the same mu
+
+    Returns
+    -------
+    value: float
+        The log of the survival function of k for a poisson with rate of mu"""
+    if k < 0:
+        return 0.0
+    if mu <= 0.0:
+        return -math.inf
+
+    if k + 1 > mu:
+        # terms after pmf(k + 1) shrink by mu / m < 1 each step
+        log_first = (k + 1) * log_mu - mu - math.lgamma(k + 2)
+        total = 1.0
+        term = 1.0
+        m = k + 2
+        while term > 1e-17 * total:
+            term *= mu / m
+            total += term
+            m += 1
+        return log_first + math.log(total)
+
+    # terms before pmf(k) shrink by m / mu <= 1 each step and the cdf is at most ~0.5 here
+    log_last = k * log_mu - mu - math.lgamma(k + 1)
+    total = 1.0
+    term = 1.0
+    for m in range(k, 0, -1):
+        term *= m / mu
+        total += term
+        if term <= 1e-17 * total:
+            break
+    return math.log1p(-math.exp(log_last + math.log(total)))
+
+
+###############################################################################
+# Latency Functions
+###############################################################################
+
+
+def latency(bsl_fr: float, firing_data: np.array, time_bin_size: float, tol: float = 1e-5) -> np.ndarray:
+    """Calculates the latency for each trial using the poisson based method of Chase and Young, 2007
+    for neurons with a baseline firing rate above 2Hz and the first spike method of Mormann et al. 2008
+    otherwise
+
+    Parameters
+    ----------
+    bsl_fr: float
+        the baseline firing rate of the neuron
+    firing_data: np.ndarray
+        The array (n_trials, n_bins) of spike counts to determine latency over
+    time_bin_size: float
+        The size of the time bin in seconds
+    tol: float, default: 1e-5
+        The poisson survival a bin must reach to be significant
+
+    Returns
+    -------
+    latency: np.ndarray
+        The float32 array of latency values, nan for trials without a latency"""
+
+    firing_data, sf_cache = _prepare_counts(firing_data, time_bin_size)
+    return _latency(bsl_fr, firing_data, time_bin_size, sf_cache, math.log(tol))
+
+
+def latency_core_stats(bsl_fr: float, firing_data: np.array, time_bin_size: float, tol: float = 1e-5) -> np.ndarray:
     """idea modified from Chase and Young, 2007: PNAS  p_tn(>=n) = 1 - sum_m_n-1 ((rt)^m e^(-rt))/m!
 
     Parameters
@@ -12,134 +96,258 @@ def latency_core_stats(bsl_fr: float, firing_data: np.array, time_bin_size: floa
     bsl_fr: float
         the baseline firing rate of the neuron (for the poisson rate)
     firing_data: np.ndarray
-        The array (n_trials, n_bins) to determine latency over
+        The array (n_trials, n_bins) of spike counts to determine latency over
     time_bin_size: float
         The size of the time bin in seconds
+    tol: float, default: 1e-5
+        The poisson survival a bin must reach to be significant
 
     Returns
     -------
     latency: np.ndarray
-        The array of latency values"""
-
-    latency = np.zeros((np.shape(firing_data)[0]))
-    for trial in range(np.shape(firing_data)[0]):
-        for n_bin in range(np.shape(firing_data)[1] - 1):
-            final_prob = 1 - poisson_cdf(
-                int(np.sum(firing_data[trial][: n_bin + 1]) - 1),
-                bsl_fr * ((n_bin + 1) * time_bin_size),
-            )
-            if final_prob <= 10e-6:
-                break
-            elif n_bin * time_bin_size >= 0.400:  # past 400 ms is not really a true latency
-                n_bin = np.shape(firing_data)[1] - 1
-                break
-
-        if n_bin == np.shape(firing_data)[1] - 1:  # need to go to second last bin
-            latency[trial] = np.nan
-        else:
-            latency[trial] = (n_bin + 1) * time_bin_size
+        The float32 array of latency values, nan for trials without a significant bin"""
 
-    return latency
+    firing_data, sf_cache = _prepare_counts(firing_data, time_bin_size)
+    return _latency_core_stats(bsl_fr, firing_data, time_bin_size, sf_cache, math.log(tol))
 
 
-@jit(nopython=True)
-def latency_median(firing_counts: np.array, time_bin_size: float):
+def latency_median(firing_counts: np.array, time_bin_size: float) -> np.ndarray:
     """ "According to Mormann et al. 2008 if neurons fire less than 2Hz they won't really
     follow a poisson distribution and so instead just take latency to first spike as the
     latency and then get the median of the trials"""
 
-    latency = np.zeros((np.shape(firing_counts)[0]))
-    for trial in range(np.shape(firing_counts)[0]):
-        min_spike_time = np.nonzero(firing_counts[trial])[0]
-        if len(min_spike_time) == 0 or (np.min(min_spike_time) + 1) * time_bin_size > 0.400:
-            latency[trial] = np.nan
-        else:
-            latency[trial] = (np.min(min_spike_time) + 1) * time_bin_size
+    firing_counts = np.ascontiguousarray(firing_counts, dtype=np.int32)
+    return _latency_median(firing_counts, time_bin_size)
 
-    return latency
 
+def latency_units(bsl_fr: np.array, firing_data: np.array, time_bin_size: float, tol: float = 1e-5) -> np.ndarray:
+    """Calculates the latency for every unit in one call, each unit uses the method `latency`
+    would pick for its baseline firing rate. Units are spread over all cores
 
-###############################################################################
-# Helper Functions for doing Poisson
-###############################################################################
-
-# look up table for factorials less than 20
-LOOKUP_TABLE = np.array(
-    [
-        1,
-        1,
-        2,
-        6,
-        24,
-        120,
-        720,
-        5040,
-        40320,
-        362880,
-        3628800,
-        39916800,
-        479001600,
-        6227020800,
-        87178291200,
-        1307674368000,
-        20922789888000,
-        355687428096000,
-        6402373705728000,
-        121645100408832000,
-        2432902008176640000,
-    ],
-    dtype="int64",
-)
-
-
-@jit(nopython=True, cache=True)
-def poisson_pdf(k: int, mu: float) -> float:
-    """just the poisson pdf
     Parameters
     ----------
-    k: int
-        The value to calculate the pdf for
-    mu: float
-        the mu of the poisson distribution
+    bsl_fr: np.ndarray
+        the baseline firing rate of each unit (n_units,)
+    firing_data: np.ndarray
+        The array (n_units, n_trials, n_bins) of spike counts to determine latency over
+    time_bin_size: float
+        The size of the time bin in seconds
+    tol: float, default: 1e-5
+        The poisson survival a bin must reach to be significant
 
     Returns
     -------
-    value: float
-        The pdf for k for a poisson of rate mu
-    """
-    return (mu**k) / factorial(k) * math.exp(-mu)
+    latency: np.ndarray
+        The float32 array (n_units, n_trials) of latency values, nan for trials without a latency"""
 
+    firing_data = np.asarray(firing_data, dtype=np.int32)
+    return _latency_units(np.asarray(bsl_fr, dtype=np.float64), firing_data, float(time_bin_size), math.log(tol))
+
+
+def latency_shuffled(
+    bsl_fr: float, firing_data: np.array, start_bins: np.array, time_bin_size: float, tol: float = 1e-5
+) -> np.ndarray:
+    """Calculates the latency of each trial for many shifted starts at once, as used for the
+    shuffled baseline distribution. Shuffle s gives the same values as `latency` on
+    firing_data[:, start_bins[s]:]
 
-@jit(nopython=True, cache=True)
-def poisson_cdf(k: int, mu: float) -> float:
-    """cdf is sum of the pdfs
     Parameters
     ----------
-    k: int
-        The value to calculate the cdf for
-    mu: float
-        the mu of the poisson distribution
+    bsl_fr: float
+        the baseline firing rate of the neuron
+    firing_data: np.ndarray
+        The array (n_trials, n_bins) of spike counts to determine latency over
+    start_bins: np.ndarray
+        The first bin of each shuffle (n_shuffles,)
+    time_bin_size: float
+        The size of the time bin in seconds
+    tol: float, default: 1e-5
+        The poisson survival a bin must reach to be significant
 
     Returns
     -------
-    value: float
-        The cdf of k for a poisson with rate of mu"""
-    value = 0.0
-    for k in range(k + 1):
-        value += poisson_pdf(k, mu)
-    return value
+    latency: np.ndarray
+        The float32 array (n_trials, n_shuffles) of latency values, nan for trials without a latency"""
 
+    firing_data = np.ascontiguousarray(firing_data, dtype=np.int32)
+    start_bins = np.ascontiguousarray(start_bins, dtype=np.int64)
+    return _latency_shuffled(bsl_fr, firing_data, start_bins, time_bin_size, math.log(tol))
 
-@jit(nopython=True, cache=True)
-def factorial(k: int) -> float:
-    """helper function that uses lookup for smaller values
-    and uses math.gamma for bigger
-    Parameters
-    ----------
-    k: int
-        The integer to perform the factorial of. Uses gamma to approximate
-        for k>20"""
-    if k <= 20:
-        return LOOKUP_TABLE[k]
+
+def _prepare_counts(firing_data: np.array, time_bin_size: float) -> tuple[np.ndarray, np.ndarray]:
+    """Converts the counts for the jitted latency functions and builds the survival cache"""
+
+    # spike counts per bin are small integers so a contiguous int32 copy keeps the bin scan cheap
+    firing_data = np.ascontiguousarray(firing_data, dtype=np.int32)
+    return firing_data, _new_sf_cache(firing_data, time_bin_size)
+
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=FASTMATH)
+def _new_sf_cache(firing_data: np.array, time_bin_size: float, any_start: bool = False) -> np.ndarray:
+    # the survival only depends on (bin, cumulative count) so it is shared between trials. Only bins
+    # up to the 400 ms cutoff are ever tested. A log survival is never positive so 1.0 marks entries
+    # which have not been computed yet. When the tested bins can start anywhere in the trial the
+    # whole trial bounds the counts
+    n_trials, n_bins = firing_data.shape
+    n_tested_bins = max(min(n_bins - 1, int(0.400 / time_bin_size) + 2), 0)
+    n_counted_bins = n_bins if any_start else n_tested_bins
+    max_count = 0
+    for trial in range(n_trials):
+        spike_count = 0
+        for n_bin in range(n_counted_bins):
+            spike_count += firing_data[trial, n_bin]
+        max_count = max(max_count, spike_count)
+    return np.full((n_tested_bins, max_count + 1), 1.0)
+
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=FASTMATH)
+def _expected_counts(bsl_fr: float, time_bin_size: float, n_tested_bins: int) -> tuple[np.ndarray, np.ndarray]:
+    # expected counts and their logs only depend on the bin so build them once for all trials
+    mu = bsl_fr * time_bin_size * np.arange(1, n_tested_bins + 1)
+    log_mu = np.full(n_tested_bins, -np.inf)
+    if bsl_fr * time_bin_size > 0:
+        log_mu = math.log(bsl_fr * time_bin_size) + np.log(np.arange(1, n_tested_bins + 1))
+    return mu, log_mu
+
+
+# the trial scans are inlined at the numba IR level so each prange body is one fused loop
+@jit(nopython=True, nogil=True, cache=True, fastmath=FASTMATH, inline="always")
+def _trial_latency_stats(
+    counts: np.array, mu: np.array, log_mu: np.array, sf_cache: np.array, time_bin_size: float, log_tol: float
+) -> np.float32:
+    spike_count = 0
+    for n_bin in range(len(mu)):
+        spike_count += counts[n_bin]
+        # every trial writes the same value for a given entry so sharing the cache is safe
+        final_log_prob = sf_cache[n_bin, spike_count]
+        if final_log_prob > 0.0:
+            # Chernoff bound P(X >= n) <= exp(-mu) * (e * mu / n)^n lets clear responses skip the poisson sum
+            log_bound = 0.0
+            if 0.0 < mu[n_bin] < spike_count:
+                log_bound = spike_count * (1.0 + log_mu[n_bin] - math.log(spike_count)) - mu[n_bin]
+            if log_bound <= log_tol:
+                final_log_prob = log_bound
+            else:
+                final_log_prob = poisson_logsf(spike_count - 1, mu[n_bin], log_mu[n_bin])
+            sf_cache[n_bin, spike_count] = final_log_prob
+        if final_log_prob <= log_tol:
+            return (n_bin + 1) * np.float32(time_bin_size)
+        elif n_bin * time_bin_size >= 0.400:  # past 400 ms is not really a true latency
+            break
+
+    return np.float32(np.nan)
+
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=FASTMATH, inline="always")
+def _trial_latency_median(counts: np.array, time_bin_size: float) -> np.float32:
+    for n_bin in range(len(counts)):
+        if counts[n_bin] != 0:
+            if (n_bin + 1) * time_bin_size > 0.400:
+                break
+            return (n_bin + 1) * np.float32(time_bin_size)
+
+    return np.float32(np.nan)
+
+
+@jit(
+    "float32[:](float64, int32[:, ::1], float64, float64[:, ::1], float64)",
+    nopython=True,
+    nogil=True,
+    parallel=True,
+    cache=True,
+    fastmath=FASTMATH,
+)
+def _latency_core_stats(
+    bsl_fr: float, firing_data: np.array, time_bin_size: float, sf_cache: np.array, log_tol: float
+) -> np.ndarray:
+    n_trials, n_bins = firing_data.shape
+    latency = np.empty(n_trials, dtype=np.float32)
+    mu, log_mu = _expected_counts(bsl_fr, time_bin_size, min(n_bins - 1, sf_cache.shape[0]))
+    for trial in prange(n_trials):
+        latency[trial] = _trial_latency_stats(firing_data[trial], mu, log_mu, sf_cache, time_bin_size, log_tol)
+
+    return latency
+
+
+@jit("float32[:](int32[:, ::1], float64)", nopython=True, nogil=True, parallel=True, cache=True, fastmath=FASTMATH)
+def _latency_median(firing_counts: np.array, time_bin_size: float) -> np.ndarray:
+    n_trials = firing_counts.shape[0]
+    latency = np.empty(n_trials, dtype=np.float32)
+    for trial in prange(n_trials):
+        latency[trial] = _trial_latency_median(firing_counts[trial], time_bin_size)
+
+    return latency
+
+
+@jit(
+    "float32[:](float64, int32[:, ::1], float64, float64[:, ::1], float64)",
+    nopython=True,
+    nogil=True,
+    cache=True,
+    fastmath=FASTMATH,
+)
+def _latency(
+    bsl_fr: float, firing_data: np.array, time_bin_size: float, sf_cache: np.array, log_tol: float
+) -> np.ndarray:
+    if bsl_fr > 2.0:
+        return _latency_core_stats(bsl_fr, firing_data, time_bin_size, sf_cache, log_tol)
+    return _latency_median(firing_data, time_bin_size)
+
+
+# the gufunc is already parallel over units so each unit uses the serial trial functions
+@guvectorize(
+    ["void(float64, int32[:, :], float64, float64, float32[:])"],
+    "(),(t,b),(),()->(t)",
+    nopython=True,
+    target="parallel",
+    cache=True,
+)
+def _latency_units(bsl_fr: float, firing_data: np.array, time_bin_size: float, log_tol: float, latency: np.array):
+    n_trials, n_bins = firing_data.shape
+    if bsl_fr > 2.0:
+        sf_cache = _new_sf_cache(firing_data, time_bin_size)
+        mu, log_mu = _expected_counts(bsl_fr, time_bin_size, min(n_bins - 1, sf_cache.shape[0]))
+        for trial in range(n_trials):
+            latency[trial] = _trial_latency_stats(firing_data[trial], mu, log_mu, sf_cache, time_bin_size, log_tol)
     else:
-        return math.gamma(k + 1)
+        for trial in range(n_trials):
+            latency[trial] = _trial_latency_median(firing_data[trial], time_bin_size)
+
+
+@jit(
+    "float32[:, :](float64, int32[:, ::1], int64[::1], float64, float64)",
+    nopython=True,
+    nogil=True,
+    parallel=True,
+    cache=True,
+    fastmath=FASTMATH,
+)
+def _latency_shuffled(
+    bsl_fr: float, firing_data: np.array, start_bins: np.array, time_bin_size: float, log_tol: float
+) -> np.ndarray:
+    n_trials, n_bins = firing_data.shape
+    latency = np.empty((n_trials, len(start_bins)), dtype=np.float32)
+    if bsl_fr > 2.0:
+        # every shuffle uses the same rate so they all share one survival cache
+        sf_cache = _new_sf_cache(firing_data, time_bin_size, True)
+        mu, log_mu = _expected_counts(bsl_fr, time_bin_size, sf_cache.shape[0])
+        for shuffle in prange(len(start_bins)):
+            start = start_bins[shuffle]
+            n_tested_bins = max(min(n_bins - start - 1, len(mu)), 0)
+            for trial in range(n_trials):
+                latency[trial, shuffle] = _trial_latency_stats(
+                    firing_data[trial, start:],
+                    mu[:n_tested_bins],
+                    log_mu[:n_tested_bins],
+                    sf_cache,
+                    time_bin_size,
+                    log_tol,
+                )
+    else:
+        for shuffle in prange(len(start_bins)):
+            for trial in range(n_trials):
+                latency[trial, shuffle] = _trial_latency_median(
+                    firing_data[trial, start_bins[shuffle] :], time_bin_size
+                )
+
+    return latency
@@ -87,14 +87,15 @@ class IntrinsicPlotter(PlotterBase):
 
         acg_bins = np.linspace(1, bin_end, num=int((bin_end / 10) + 1), dtype=np.int32)
 
-        for cluster in cluster_ids:
-            these_spikes = spike_times[spike_clusters == cluster]
-
-            if len(these_spikes) == 0:
-                continue
-
-            spike_counts, bin_centers = hf.histdiff(these_spikes, these_spikes, acg_bins)
-
+        # map each spike to the row of its cluster so all the acgs come from one pass over the spikes
+        cluster_order = np.argsort(cluster_ids)
+        sorted_ids = np.asarray(cluster_ids)[cluster_order]
+        position = np.minimum(np.searchsorted(sorted_ids, spike_clusters), len(sorted_ids) - 1)
+        unit_index = np.where(sorted_ids[position] == spike_clusters, cluster_order[position], -1)
+        acgs, _ = hf.spike_times_to_acg(spike_times, unit_index, len(cluster_ids), acg_bins)
+
+        for cluster, spike_counts in zip(cluster_ids, acgs):
+            # clusters without spikes have an empty acg as well
             if np.sum(spike_counts) == 0:
                 continue
 
@@ -1,3 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from multiprocessing import get_context
+from pathlib import Path
 from typing import Union, Optional
 
 import numpy as np
@@ -15,18 +20,151 @@ _possible_analog = ("get_analog_data", "digitize_analog_data")
 _possible_qc = ("generate_pcs", "refractory_violation", "generate_qcmetrics", "qc_preprocessing")
 
 
+@dataclass
+class EventSet:
+    """Event times, lengths, trial groups and stimulus name of one stimulus channel"""
+
+    events: np.ndarray
+    lengths: np.ndarray
+    trial_groups: np.ndarray
+    stim: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, event_values: dict) -> "EventSet":
+        return cls(
+            events=np.asarray(event_values.get("events", ())),
+            lengths=np.asarray(event_values.get("lengths", ())),
+            trial_groups=np.asarray(event_values.get("trial_groups", ())),
+            stim=event_values.get("stim"),
+        )
+
+    def __getitem__(self, key: str):
+        # keep the old dict style access, e.g. events[channel]["lengths"], working
+        return getattr(self, key)
+
+
+def _window_slices(bins: np.array, window: list) -> list[slice]:
+    """Slices of the sorted bins that lie strictly inside the (start, stop) pairs of the window. Overlapping
+    pairs are merged so that no bin is used twice"""
+    bounds = sorted(
+        (np.searchsorted(bins, start, side="right"), np.searchsorted(bins, stop, side="left"))
+        for start, stop in zip(window[::2], window[1::2])
+    )
+    window_slices = []
+    for first_bin, last_bin in bounds:
+        if last_bin <= first_bin:
+            continue
+        if window_slices and first_bin <= window_slices[-1].stop:
+            window_slices[-1] = slice(window_slices[-1].start, max(window_slices[-1].stop, last_bin))
+        else:
+            window_slices.append(slice(first_bin, last_bin))
+    return window_slices
+
+
+def _group_z_parameters(z_params: dict) -> list[tuple]:
+    """Groups the keys of z parameters by their time window so each window is checked in one sweep. Gives
+    the window, keys, scores, n_bins and whether each key counts the bins below its score (inhibitory)"""
+    window_keys = {}
+    for key, value in z_params.items():
+        window_keys.setdefault(tuple(value["time"]), []).append(key)
+
+    z_groups = []
+    for current_window, keys in window_keys.items():
+        if len(current_window) not in (2, 4):
+            raise Exception(f"Not implmented for window of size {len(current_window)} possible lengths are 2 or 4")
+
+        current_scores = np.array([z_params[key]["score"] for key in keys], dtype=np.float32)[:, None, None, None]
+        current_n_bins = np.array([z_params[key]["n_bins"] for key in keys])[:, None, None]
+        inhibitory = np.array([z_params[key]["score"] <= 0 and "inhib" in key.lower() for key in keys])
+        z_groups.append((current_window, keys, current_scores, current_n_bins, inhibitory))
+
+    return z_groups
+
+
+def _kept_mean(sub_correlations: np.array) -> np.array:
+    # as before, correlations of 1 (the diagonal and identical repeats) are left out of the means. nan fails the
+    # comparison too so one mask covers both and the means need no nan handling
+    kept_correlations = sub_correlations <= 1 - 1e-12
+    return np.sum(sub_correlations, axis=-1, where=kept_correlations) / np.count_nonzero(kept_correlations, axis=-1)
+
+
+def _first_row_correlation(trial_data: np.array) -> np.array:
+    """Mean correlation of the first repeat of each cluster against its other repeats, leaving out correlations
+    of 1 (itself and identical repeats). trial_data holds the centered unit norm repeats of every cluster and the
+    first repeat is the first one whose mean is finite"""
+    # repeats without variance are all nan, so for most clusters the first repeat with variance gives the
+    # reported mean and only its row of the correlation matrix is needed
+    has_variance = np.isfinite(trial_data[:, :, 0])
+    first_repeat = np.argmax(has_variance, axis=1)
+    selected_repeat = np.take_along_axis(trial_data, first_repeat[:, None, None], axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        row_correlations = _kept_mean(np.matmul(trial_data, selected_repeat.transpose(0, 2, 1))[:, :, 0])
+
+        # if every other repeat matches the selected one the reported row is a later one, so those clusters
+        # still get the full correlation matrix
+        full_clusters = np.flatnonzero(~np.isfinite(row_correlations) & (np.count_nonzero(has_variance, axis=1) > 1))
+        if len(full_clusters):
+            cluster_data = trial_data[full_clusters]
+            all_rows = _kept_mean(np.matmul(cluster_data, cluster_data.transpose(0, 2, 1)))
+            first_finite_row = np.argmax(np.isfinite(all_rows), axis=1)
+            row_correlations[full_clusters] = np.take_along_axis(all_rows, first_finite_row[:, None], axis=1)[:, 0]
+
+    return row_correlations
+
+
+def _correlate_trial_groups(
+    current_data: np.array, current_bins: np.array, trial_groups: np.array, current_window: list
+) -> np.array:
+    """Mean pairwise correlation of the repeats of each cluster and trial group of one stimulus. Kept at
+    module level so that trial_correlation can hand it to worker processes"""
+    # sorting the events by trial group makes every group a contiguous run of the psth
+    trial_set, trial_index = np.unique(trial_groups, return_inverse=True)
+    trial_order = np.argsort(trial_index, kind="stable")
+    trial_bounds = np.searchsorted(trial_index[trial_order], np.arange(len(trial_set) + 1))
+
+    correlations = np.zeros((np.shape(current_data)[0], len(trial_set)))
+    window_slices = _window_slices(current_bins, current_window)
+    if len(window_slices) == 0:
+        # no bins to correlate in this window
+        correlations[:] = np.nan
+        return correlations
+
+    # one contiguous float copy of the window with the events ordered by trial group. The window is a plain slice
+    # of the sorted bins so only the events need gathering
+    normalized_data = current_data[:, trial_order, window_slices[0]].astype(np.float64)
+
+    # centering and scaling each repeat to unit norm does not depend on its trial group so it is done once in
+    # place, then the pearson correlations are just matrix multiplies of the rows
+    normalized_data -= np.mean(normalized_data, axis=2, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # repeats without any variance become nan rows/columns just like pandas corr
+        normalized_data /= np.linalg.norm(normalized_data, axis=2, keepdims=True)
+
+    for trial_number in range(len(trial_set)):
+        trial_data = normalized_data[:, trial_bounds[trial_number] : trial_bounds[trial_number + 1], :]
+        correlations[:, trial_number] = _first_row_correlation(trial_data)
+
+    return correlations
+
+
+@lru_cache
+def _public_methods(cls: type) -> tuple:
+    # the methods of a class never change so the dir() scan only needs to happen once per class
+    return tuple(method for method in dir(cls) if "__" not in method and method[0] != "_")
+
+
 class SpikeAnalysis:
     """Class for spike train analysis utilizing a SpikeData object and a StimulusData object"""
 
     def __init__(self):
         self._file_path = None
         self.events = {}
+        self._rebin_cache = {}
 
     def __repr__(self):
-        var_methods = dir(self)
         var = list(vars(self).keys())  # get our currents variables
-        methods = list(set(var_methods) - set(var))
-        final_methods = [method for method in methods if "__" not in method and method[0] != "_"]
+        final_methods = [method for method in _public_methods(type(self)) if method not in vars(self)]
         final_vars = [current_var for current_var in var if "_" not in current_var]
         return f"The methods are: {final_methods} Variables are: {final_vars}"
 
@@ -81,7 +219,8 @@ class SpikeAnalysis:
                 print("no qc run")
 
         self.raw_spike_times = sp.raw_spike_times
-        self.cluster_ids = sp._cids
+        # SpikeData sorts its cids, sorting again guards cids set by hand as spikes are matched with searchsorted
+        self.cluster_ids = np.sort(sp._cids)
         self.spike_clusters = sp.spike_clusters
         self._sampling_rate = sp._sampling_rate
 
@@ -130,14 +269,17 @@ class SpikeAnalysis:
             print("There is no raw analog data provided. Run get_analog_data if needed.")
 
         if self.HAVE_DIGITAL and self.HAVE_DIG_ANALOG:
-            self.events = self._merge_events(self.digital_events, self.dig_analog_events)
+            events = self._merge_events(self.digital_events, self.dig_analog_events)
         elif self.HAVE_DIGITAL:
-            self.events = self.digital_events
+            events = self.digital_events
         elif self.HAVE_DIG_ANALOG:
-            self.events = self.dig_analog_events
+            events = self.dig_analog_events
         else:
             raise Exception("Code requires some stimulus data")
 
+        # convert the event values to arrays once here rather than in every analysis method
+        self.events = {channel: EventSet.from_dict(event_values) for channel, event_values in events.items()}
+
     def get_raw_psth(
         self,
         window: Union[list, list[list]],
@@ -176,40 +318,33 @@ class SpikeAnalysis:
         psths = {}
 
         for idx, stimulus in enumerate(self.events.keys()):
-            multispike_bin = 0
-            events = np.array(self.events[stimulus]["events"])
-            stim_name = self.events[stimulus]["stim"]
+            event_set = self._event_set(stimulus)
+            events = event_set.events
+            stim_name = event_set.stim
             print(f"{stim_name}\n")
             current_window = windows[idx]
 
             window_start = np.int64(current_window[0] * self._sampling_rate)
             window_end = np.int64(current_window[1] * self._sampling_rate)
-            psth = np.zeros(
-                (
-                    len(cluster_ids),
-                    len(events),
-                    int((window_end - window_start) / time_bin_size),
-                ),
-                dtype=np.int32,
-            )
-
             psths[stim_name] = {}
             min_time = np.min(events) + window_start
             max_time = np.max(events) + window_end
-            current_spike_clusters = spike_clusters[np.logical_and(spike_times > min_time, spike_times < max_time)]
-            current_spikes = spike_times[np.logical_and(spike_times > min_time, spike_times < max_time)]
-
-            for idy, cluster in enumerate(tqdm(cluster_ids)):
-                spikes_array, bins_sub = hf.spike_times_to_bins(
-                    current_spikes[current_spike_clusters == cluster],
-                    events,
-                    time_bin_size,
-                    window_start,
-                    window_end,
-                )
-                psth[idy] = spikes_array
-                if len(np.where(spikes_array > 1)[0]) != 0 or len(np.where(spikes_array > 1)[1]) != 0:
-                    multispike_bin += 1
+            # spike times are sorted so the window is a contiguous slice (min_time, max_time)
+            start = np.searchsorted(spike_times, min_time, side="right")
+            stop = np.searchsorted(spike_times, max_time, side="left")
+            current_spike_clusters = spike_clusters[start:stop]
+            current_spikes = spike_times[start:stop]
+
+            psth, bins_sub = hf.spike_times_to_unit_bins(
+                current_spikes,
+                self._unit_index(current_spike_clusters),
+                len(cluster_ids),
+                events,
+                time_bin_size,
+                window_start,
+                window_end,
+            )
+            multispike_bin = int(np.any(psth > 1, axis=(1, 2)).sum())
             if multispike_bin:
                 print(f"Minimum time_bin size in ms is {1000/self._sampling_rate}")
                 print(
@@ -220,6 +355,7 @@ class SpikeAnalysis:
 
         self.NUM_STIM = TOTAL_STIM
         self.psths = psths
+        self._rebin_cache = {}
 
     def get_raw_firing_rate(
         self,
@@ -288,16 +424,15 @@ class SpikeAnalysis:
                 ), "Enter one smoothing value per stim or one global smoothing value"
 
         self.fr_windows = {}
-        fr = {}
         final_fr = {}
         self.fr_bins = {}
         self.raw_firing_rate = {}
-        for idx, stim in enumerate(self.psths.keys()):
+        for idx, stim in enumerate(tqdm(self.psths.keys())):
             print(stim)
 
-            trials = self.events[stim_dict[stim]]["trial_groups"]
+            trials = self._event_set(stim_dict[stim]).trial_groups
 
-            trial_set = np.sort(np.unique(np.array(trials)))
+            trial_set = np.unique(trials)
             time_bin_current = time_bin_size[idx]
 
             psth = psths[stim]["psth"]
@@ -312,41 +447,42 @@ class SpikeAnalysis:
             new_bin_number = np.int32((n_bins * bin_size) / time_bin_current)
 
             if new_bin_number != n_bins:
-                psth = hf.convert_to_new_bins(psth, new_bin_number)
-                bins = hf.convert_bins(bins, new_bin_number)
+                used_windows = [fr_window_current, bsl_current] if baseline else [fr_window_current]
+                psth, bins = self._rebinned(stim, new_bin_number, used_windows)
             if baseline:
-                bsl_values = np.logical_and(bins >= bsl_current[0], bins <= bsl_current[1])
+                bsl_values = np.flatnonzero(np.logical_and(bins >= bsl_current[0], bins <= bsl_current[1]))
                 bsl_psth = psth[:, :, bsl_values]
 
-            fr_window_values = np.logical_and(bins >= fr_window_current[0], bins <= fr_window_current[1])
+            fr_window_values = np.flatnonzero(
+                np.logical_and(bins >= fr_window_current[0], bins <= fr_window_current[1])
+            )
             fr_psth = psth[:, :, fr_window_values]
-            fr[stim] = np.zeros(np.shape(fr_psth))
-            final_fr[stim] = np.zeros((np.shape(fr_psth)[0], len(trial_set), np.shape(fr_psth)[2]))
-            self.raw_firing_rate[stim] = np.zeros(np.shape(fr_psth))
-
-            for trial_number, trial in enumerate(tqdm(trial_set)):
+            # float32 is plenty for rates built from spike counts and halves the memory of these arrays
+            final_fr[stim] = np.zeros((np.shape(fr_psth)[0], len(trial_set), np.shape(fr_psth)[2]), dtype=np.float32)
+            self.raw_firing_rate[stim] = np.zeros(np.shape(fr_psth), dtype=np.float32)
+
+            # index each trial group once instead of rebuilding the mask for every use
+            trial_indices = [np.flatnonzero(trials == trial) for trial in trial_set]
+            for trial_number, trial in enumerate(trial_set):
+                trial_index = trial_indices[trial_number]
                 if baseline:
-                    bsl_trial = bsl_psth[:, trials == trial, :]
+                    bsl_trial = bsl_psth[:, trial_index, :]
                     mean_fr = np.mean(np.sum(bsl_trial, axis=2), axis=1) / ((bsl_current[1] - bsl_current[0]))
+                    mean_fr = mean_fr.astype(np.float32)
 
-                fr_trial = fr_psth[:, trials == trial, :] / time_bin_current
+                fr_trial = np.divide(fr_psth[:, trial_index, :], time_bin_current, dtype=np.float32)
                 if mode == "raw":
                     fr_trial = fr_trial
                 elif mode == "smooth":
                     sm_std = int((1 / ((bins[1] - bins[0]) * 1000))) * sm_time_ms[idx]  # convert from user input
                     if sm_std % 2 == 0:  # make it odd so it has a peak convolution bin
                         sm_std += 1
-                    for cluster_number in range(np.shape(fr_trial)[0]):
-                        fr_trial[cluster_number] = gaussian_smoothing(
-                            fr_trial[cluster_number], (bins[1] - bins[0]), sm_std
-                        )
+                    fr_trial = gaussian_smoothing(fr_trial, (bins[1] - bins[0]), sm_std)
                 else:
-                    for row in range(len(mean_fr)):
-                        fr_trial[row] = fr_trial[row] - mean_fr[row]
+                    fr_trial -= mean_fr[:, None, None]
 
-                fr[stim][:, trials == trial, :] = fr_trial[:, :, :]
                 final_fr[stim][:, trial_number, :] = np.nanmean(fr_trial, axis=1)
-                self.raw_firing_rate[stim][:, trials == trial, :] = fr_trial[:, :, :]
+                self.raw_firing_rate[stim][:, trial_index, :] = fr_trial
                 self.fr_bins[stim] = bins[fr_window_values]
             self.mean_firing_rate = final_fr
 
@@ -404,7 +540,6 @@ class SpikeAnalysis:
 
         z_windows = verify_window_format(window=z_window, num_stim=NUM_STIM)
 
-        z_scores = {}
         final_z_scores = {}
         self.z_windows = {}
         self.z_bins = {}
@@ -412,9 +547,9 @@ class SpikeAnalysis:
         for idx, stim in enumerate(self.psths.keys()):
             print(stim)
 
-            trials = self.events[stim_dict[stim]]["trial_groups"]
+            trials = self._event_set(stim_dict[stim]).trial_groups
 
-            trial_set = np.sort(np.unique(np.array(trials)))
+            trial_set = np.unique(trials)
             time_bin_current = time_bin_size[idx]
 
             psth = psths[stim]["psth"]
@@ -428,28 +563,45 @@ class SpikeAnalysis:
             new_bin_number = np.int32((n_bins * bin_size) / time_bin_current)
 
             if new_bin_number != n_bins:
-                psth = hf.convert_to_new_bins(psth, new_bin_number)
-                bins = hf.convert_bins(bins, new_bin_number)
-            bsl_values = np.logical_and(bins >= bsl_current[0], bins <= bsl_current[1])
-            z_window_values = np.logical_and(bins >= z_window_current[0], bins <= z_window_current[1])
+                psth, bins = self._rebinned(stim, new_bin_number, [z_window_current, bsl_current])
+            bsl_values = np.flatnonzero(np.logical_and(bins >= bsl_current[0], bins <= bsl_current[1]))
+            z_window_values = np.flatnonzero(np.logical_and(bins >= z_window_current[0], bins <= z_window_current[1]))
             bsl_psth = psth[:, :, bsl_values]
             z_psth = psth[:, :, z_window_values]
-            z_scores[stim] = np.zeros(np.shape(z_psth))
-            self.raw_zscores[stim] = np.zeros(np.shape(z_psth))
-            final_z_scores[stim] = np.zeros((np.shape(z_psth)[0], len(trial_set), np.shape(z_psth)[2]))
-            for trial_number, trial in enumerate(tqdm(trial_set)):
-                bsl_trial = bsl_psth[:, trials == trial, :]
-                mean_fr = np.mean(np.sum(bsl_trial, axis=2), axis=1) / ((bsl_current[1] - bsl_current[0]))
-                std_fr = np.std(np.sum(bsl_trial, axis=2), axis=1) / ((bsl_current[1] - bsl_current[0]))
-                z_trial = z_psth[:, trials == trial, :] / time_bin_current
-                z_trials = hf.z_score_values(z_trial, mean_fr, std_fr)
-                z_scores[stim][:, trials == trial, :] = z_trials[:, :, :]
-                final_z_scores[stim][:, trial_number, :] = np.nanmean(z_trials, axis=1)
-                self.raw_zscores[stim][:, trials == trial, :] = z_trials[:, :, :]
+            # sort the events by trial group so every group is a contiguous run for reduceat
+            group_index = np.searchsorted(trial_set, trials)
+            group_order = np.argsort(group_index, kind="stable")
+            group_sizes = np.bincount(group_index, minlength=len(trial_set))
+            group_starts = np.cumsum(group_sizes) - group_sizes
+
+            bsl_sums = np.sum(bsl_psth, axis=2)[:, group_order]
+            mean_sums = np.add.reduceat(bsl_sums, group_starts, axis=1) / group_sizes
+            deviations = bsl_sums - np.repeat(mean_sums, group_sizes, axis=1)
+            std_sums = np.sqrt(np.add.reduceat(deviations**2, group_starts, axis=1) / group_sizes)
+            mean_fr = (mean_sums / (bsl_current[1] - bsl_current[0])).astype(np.float32)
+            std_fr = (std_sums / (bsl_current[1] - bsl_current[0])).astype(np.float32)
+
+            # units without baseline variance give inf/nan z scores just like before
+            with np.errstate(divide="ignore", invalid="ignore"):
+                z_trials = np.divide(z_psth, time_bin_current, dtype=np.float32)
+                z_trials = (z_trials - mean_fr[:, group_index, None]) / std_fr[:, group_index, None]
+                sorted_z = z_trials[:, group_order, :]
+                finite_z = ~np.isnan(sorted_z)
+                final_z_scores[stim] = np.add.reduceat(
+                    np.where(finite_z, sorted_z, np.float32(0)), group_starts, axis=1
+                ) / np.add.reduceat(finite_z, group_starts, axis=1).astype(np.float32)
+            self.raw_zscores[stim] = z_trials
             self.z_bins[stim] = bins[z_window_values]
         self.z_scores = final_z_scores
 
-    def latencies(self, bsl_window: Union[list, list[float]], time_bin_ms: float = 50.0, num_shuffles: int = 300):
+    def latencies(
+        self,
+        bsl_window: Union[list, list[float]],
+        time_bin_ms: float = 50.0,
+        num_shuffles: int = 300,
+        seed: Optional[int] = None,
+        tol: float = 1e-5,
+    ):
         """
         Calculates the latency to fire for each neuron based on either Chase & Young 2007 or
         Mormann et al. 2012 with the cutoff being a baseline firing rate of 2Hz
@@ -463,6 +615,12 @@ class SpikeAnalysis:
             Size of new time bins to use.
         num_shuffles : int
             The number of shuffles to perform for finding the shuffled distribution, default 300
+        seed : Optional[int]
+            Seed for the random baseline starts of the shuffled distribution so it can be reproduced,
+            default None gives a new distribution every run
+        tol: float
+            The Poisson probability below which a bin counts as the response for units above 2Hz,
+            default 1e-5. Smaller values give a stricter threshold
 
         Returns
         -------
@@ -477,10 +635,11 @@ class SpikeAnalysis:
         stim_dict = self._get_key_for_stim()
         psths = self.psths
         self.latency = {}
-        for idx, stim in enumerate(self.psths.keys()):
-            trials = self.events[stim_dict[stim]]["trial_groups"]
+        rng = np.random.default_rng(seed)
+        for idx, stim in enumerate(tqdm(self.psths.keys())):
+            trials = self._event_set(stim_dict[stim]).trial_groups
             print(stim)
-            trial_set = np.unique(np.array(trials))
+            trial_set = np.unique(trials)
             current_bsl = bsl_windows[idx]
             psth = psths[stim]["psth"]
             bins = psths[stim]["bins"]
@@ -490,18 +649,13 @@ class SpikeAnalysis:
             new_bin_number = np.int32((n_bins * time_bin_size) / time_bin_seconds)
 
             if new_bin_number != n_bins:
-                psth = hf.convert_to_new_bins(psth, new_bin_number)
-                bins = hf.convert_bins(bins, new_bin_number)
+                # the baseline and the response from 0 to the end of the psth are used, whichever starts first
+                psth, bins = self._rebinned(stim, new_bin_number, [[min(current_bsl[0], 0), np.inf]])
             final_time_bin_size = bins[1] - bins[0]
-            bsl_shuffled = (
-                np.random.rand(
-                    np.shape(psth)[0],
-                    len(trial_set),
-                    num_shuffles,
-                )
-                * (current_bsl[1] - current_bsl[0])
-                + current_bsl[0]
-            )
+            # float32 starts are precise enough to pick a bin and halve the size of this array
+            bsl_shuffled = rng.random((np.shape(psth)[0], len(trial_set), num_shuffles), dtype=np.float32)
+            bsl_shuffled *= current_bsl[1] - current_bsl[0]
+            bsl_shuffled += current_bsl[0]
 
             self.latency[stim] = {
                 "latency": np.empty((np.shape(psth)[0], np.shape(psth)[1])),
@@ -510,46 +664,31 @@ class SpikeAnalysis:
 
             bsl_values = np.mean(
                 np.sum(
-                    psth[:, :, np.logical_and(bins >= current_bsl[0], bins <= current_bsl[1])],
+                    psth[:, :, np.flatnonzero(np.logical_and(bins >= current_bsl[0], bins <= current_bsl[1]))],
                     axis=2,
                 )
                 / (current_bsl[1] - current_bsl[0]),
                 axis=1,
             )
 
+            response_bins = np.flatnonzero(bins >= 0)
+            trial_indices = [np.flatnonzero(trials == trial) for trial in trial_set]
             for t_number, trial in enumerate(trial_set):
-                current_psth = psth[:, trials == trial, :]
+                trial_index = trial_indices[t_number]
+                current_psth = psth[:, trial_index, :]
 
                 bsl_shuffled_trial = bsl_shuffled[:, t_number, :]
 
+                # each unit uses Chase & Young above 2Hz and Mormann et al. otherwise
+                self.latency[stim]["latency"][:, trial_index] = 1000 * lf.latency_units(
+                    bsl_values, current_psth[:, :, response_bins], final_time_bin_size, tol
+                )
                 for idx in range(len(bsl_values)):
-                    psth_by_trial = current_psth[idx]
-                    bsl_fr = bsl_values[idx]
-                    bsl_shuffled_trial_cluster = bsl_shuffled_trial[idx]
-
-                    if bsl_fr > 2:
-                        self.latency[stim]["latency"][idx, trials == trial] = 1000 * lf.latency_core_stats(
-                            bsl_fr, psth_by_trial[:, bins >= 0], final_time_bin_size
-                        )
-                        for shuffle in tqdm(range(num_shuffles)):
-                            self.latency[stim]["latency_shuffled"][
-                                idx, trials == trial, shuffle
-                            ] = 1000 * lf.latency_core_stats(
-                                bsl_fr,
-                                psth_by_trial[:, bins >= bsl_shuffled_trial_cluster[shuffle]],
-                                final_time_bin_size,
-                            )
-
-                    else:
-                        self.latency[stim]["latency"][idx, trials == trial] = 1000 * lf.latency_median(
-                            psth_by_trial[:, bins >= 0], final_time_bin_size
-                        )
-                        for shuffle in tqdm(range(num_shuffles)):
-                            self.latency[stim]["latency_shuffled"][
-                                idx, trials == trial, shuffle
-                            ] = 1000 * lf.latency_median(
-                                psth_by_trial[:, bins >= bsl_shuffled_trial_cluster[shuffle]], final_time_bin_size
-                            )
+                    # bins >= start for each shuffled start is the slice from its sorted position on
+                    start_bins = np.searchsorted(bins, bsl_shuffled_trial[idx], side="left")
+                    self.latency[stim]["latency_shuffled"][idx, trial_index, :] = 1000 * lf.latency_shuffled(
+                        bsl_values[idx], current_psth[idx], start_bins, final_time_bin_size, tol
+                    )
 
     def get_interspike_intervals(self):
         """
@@ -564,14 +703,20 @@ class SpikeAnalysis:
         spike_clusters = self.spike_clusters
         cluster_ids = self.cluster_ids
 
+        # one stable sort groups the spikes by cluster while keeping their time order, so every
+        # cluster's times and isis are slices of the same two arrays instead of a mask per cluster
+        spike_order = np.argsort(spike_clusters, kind="stable")
+        sorted_times = spike_times[spike_order]
+        sorted_clusters = spike_clusters[spike_order]
+        all_isi = np.diff(sorted_times)
+        starts = np.searchsorted(sorted_clusters, cluster_ids, side="left")
+        stops = np.searchsorted(sorted_clusters, cluster_ids, side="right")
+
         isi_raw = {}
 
-        for cluster in tqdm(cluster_ids):
-            isi_raw[cluster] = {}
-            these_spikes = spike_times[spike_clusters == cluster]
-            isi = np.diff(these_spikes)
-            isi_raw[cluster]["times"] = these_spikes[:-1]
-            isi_raw[cluster]["isi"] = isi
+        for cluster, start, stop in zip(cluster_ids, starts, stops):
+            last = max(stop - 1, start)
+            isi_raw[cluster] = {"times": sorted_times[start:last], "isi": all_isi[start:last]}
 
         self.isi_raw = isi_raw
 
@@ -594,46 +739,49 @@ class SpikeAnalysis:
         final_isi = {}
         raw_data = {}
         for idx, stimulus in enumerate(self.events.keys()):
-            events = np.array(self.events[stimulus]["events"])
-            lengths = np.array(self.events[stimulus]["lengths"])
-            stim_name = self.events[stimulus]["stim"]
+            event_set = self._event_set(stimulus)
+            events = event_set.events
+            lengths = event_set.lengths
+            stim_name = event_set.stim
             raw_data[stim_name] = {}
             final_isi[stim_name] = {}
-            final_counts = np.zeros((len(self.isi_raw.keys()), len(events), len(bins) - 1))
-            final_counts_bsl = np.zeros((len(self.isi_raw.keys()), len(events), len(bins) - 1))
+            # response windows followed by baseline windows so each cluster needs one lookup and one bincount
+            window_starts = np.concatenate((events, events - lengths[idx]))
+            window_stops = np.concatenate((events + lengths[idx], events))
+            all_counts = np.zeros((2, len(self.isi_raw.keys()), len(events), len(bins) - 1))
+            final_counts = all_counts[0]
+            final_counts_bsl = all_counts[1]
             for idy, cluster in enumerate(self.isi_raw.keys()):
                 current_times = self.isi_raw[cluster]["times"]
                 cluster_isi_raw = self.isi_raw[cluster]["isi"]
-                raw_data[stim_name][cluster] = {"isi_values": [], "bsl_isi_values": []}
-                for idz, event in enumerate(events):
-                    current_isi_raw = cluster_isi_raw[
-                        np.logical_and(current_times > event, current_times < event + lengths[idx])
-                    ]
-                    baseline_isi_raw = cluster_isi_raw[
-                        np.logical_and(current_times > event - lengths[idx], current_times < event)
-                    ]
-
-                    isi_counts, isi_bins = np.histogram(current_isi_raw / self._sampling_rate, bins=bins)
-                    bsl_counts, _ = np.histogram(baseline_isi_raw / self._sampling_rate, bins=bins)
-                    final_counts[idy, idz, :] = isi_counts
-                    final_counts_bsl[idy, idz, :] = bsl_counts
-                    raw_data[stim_name][cluster]["isi_values"].append(list(current_isi_raw / self._sampling_rate))
-                    raw_data[stim_name][cluster]["bsl_isi_values"].append(list(baseline_isi_raw / self._sampling_rate))
-                raw_data[stim_name][cluster]["isi_values"] = np.array(
-                    [value for sub_list in raw_data[stim_name][cluster]["isi_values"] for value in sub_list]
-                )
-                raw_data[stim_name][cluster]["bsl_isi_values"] = np.array(
-                    [value for sub_list in raw_data[stim_name][cluster]["bsl_isi_values"] for value in sub_list]
-                )
+                window_index, isi_index = hf.window_indices(current_times, window_starts, window_stops)
+                isi_values = cluster_isi_raw[isi_index] / self._sampling_rate
+                # same bins as np.histogram, the last bin includes the final edge
+                bin_index = np.searchsorted(bins, isi_values, side="right") - 1
+                bin_index[isi_values == bins[-1]] = len(bins) - 2
+                in_range = bin_index < len(bins) - 1
+                all_counts[:, idy] = np.bincount(
+                    window_index[in_range] * (len(bins) - 1) + bin_index[in_range],
+                    minlength=2 * len(events) * (len(bins) - 1),
+                ).reshape(2, len(events), len(bins) - 1)
+                n_response = np.searchsorted(window_index, len(events))
+                raw_data[stim_name][cluster] = {
+                    "isi_values": isi_values[:n_response],
+                    "bsl_isi_values": isi_values[n_response:],
+                }
             final_isi[stim_name]["isi"] = final_counts
             final_isi[stim_name]["bsl_isi"] = final_counts_bsl
-            final_isi[stim_name]["bins"] = isi_bins
+            final_isi[stim_name]["bins"] = bins
 
         self.isi = final_isi
         self.isi_values = raw_data
 
     def trial_correlation(
-        self, window: Union[list, list[list]], time_bin_ms: Optional[float] = None, dataset: str = "psth"
+        self,
+        window: Union[list, list[list]],
+        time_bin_ms: Optional[float] = None,
+        dataset: str = "psth",
+        n_jobs: int = 1,
     ):
         """
         Function to calculate pairwise pearson correlation coefficents of z scored or raw firing rate data/time bin.
@@ -649,11 +797,15 @@ class SpikeAnalysis:
                artificial differences in trials.
         dataset : str, (psth, z_scores)
             Whether to use the psth (raw spike counts) or z_scored data. The default is 'z_scores'.
+        n_jobs : int, optional
+            Number of processes used to correlate the stimuli in parallel. The default is 1 (no extra processes).
+            Workers are spawned rather than forked (numba's threading layer is not fork safe) so scripts using
+            n_jobs > 1 need an ``if __name__ == "__main__":`` guard.
 
         Raises
         ------
         Exception
-            For not having pandas, incorrect dataset type
+            For incorrect dataset type
 
         Returns
         -------
@@ -662,10 +814,6 @@ class SpikeAnalysis:
         """
 
         assert dataset == "psth", "z-score is wip please only use psth for now"
-        try:
-            import pandas as pd
-        except ImportError:
-            raise Exception("pandas is required for correlation function, install with pip or conda")
 
         if dataset == "psth":
             try:
@@ -704,9 +852,9 @@ class SpikeAnalysis:
         else:
             time_bin_size = [None] * self.NUM_STIM
 
-        correlations = {}
+        stim_args = []
         for idx, stimulus in enumerate(data.keys()):
-            trial_groups = np.array(self.events[stim_dict[stimulus]]["trial_groups"])
+            trial_groups = self._event_set(stim_dict[stimulus]).trial_groups
             current_window = windows[idx]
             current_data = data[stimulus]
 
@@ -715,7 +863,6 @@ class SpikeAnalysis:
                 current_data = current_data["psth"]
             else:
                 current_bins = bins[stimulus]
-            correlations[stimulus] = np.zeros((np.shape(current_data)[0], len(set(trial_groups))))
             n_bins = len(current_bins)
 
             time_bin_current = time_bin_size[idx]
@@ -731,27 +878,16 @@ class SpikeAnalysis:
             if n_bins != new_bin_number:
                 current_data = hf.convert_to_new_bins(current_data, new_bin_number)
                 current_bins = hf.convert_bins(current_bins, new_bin_number)
+            stim_args.append((current_data, current_bins, trial_groups, current_window))
 
-            correlation_window = np.logical_and(current_bins > current_window[0], current_bins < current_window[1])
-
-            current_data_windowed = current_data[:, :, correlation_window]
-
-            for trial_number, trial in enumerate(tqdm(set(trial_groups))):
-                current_data_windowed_by_trial = current_data_windowed[:, trial_groups == trial, :]
-
-                for cluster_number in range(np.shape(current_data_windowed_by_trial)[0]):
-                    final_sub_data = np.squeeze(current_data_windowed_by_trial[cluster_number])
-                    data_dataframe = pd.DataFrame(np.squeeze(final_sub_data.T))
-
-                    sub_correlations = data_dataframe.corr()
-                    masked_correlations = sub_correlations[sub_correlations != 1]
-                    for row in range(np.shape(masked_correlations)[0]):
-                        final_correlations = np.nanmean(masked_correlations.iloc[row, :])
-                        if np.isfinite(final_correlations):
-                            break
-                    correlations[stimulus][cluster_number, trial_number] = final_correlations
+        if n_jobs == 1 or len(stim_args) < 2:
+            stim_correlations = [_correlate_trial_groups(*args) for args in tqdm(stim_args)]
+        else:
+            # the stimuli are independent so each one can be correlated in its own process
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=get_context("spawn")) as executor:
+                stim_correlations = list(executor.map(_correlate_trial_groups, *zip(*stim_args)))
 
-        self.correlations = correlations
+        self.correlations = dict(zip(data.keys(), stim_correlations))
 
     def autocorrelogram(self):
         """function for calculating the autocorrelogram of the spikes"""
@@ -762,14 +898,22 @@ class SpikeAnalysis:
         bin_end = 0.5 * sample_rate  # 500 ms around spike
         acg_bins = np.linspace(1, bin_end, num=int(bin_end / 2), dtype=np.int32)
 
-        acg = np.zeros((len(cluster_ids), len(acg_bins) - 1))
+        unit_index = self._unit_index(spike_clusters)
 
-        for idx, cluster in enumerate(tqdm(cluster_ids)):
-            these_spikes = spike_times[spike_clusters == cluster]
-            spike_counts, bin_centers = hf.histdiff(these_spikes, these_spikes, acg_bins)
-            acg[idx] = spike_counts
+        # the sweep visits every pair of spikes closer than bin_end while the fft always pays for the whole
+        # recording, so only units dense enough to have more pairs than that go through the fft
+        n_spikes = np.bincount(unit_index[unit_index >= 0], minlength=len(cluster_ids))
+        n_fft = np.ptp(spike_times) + bin_end if len(spike_times) else bin_end
+        pair_estimate = n_spikes.astype(np.float64) ** 2 * bin_end / n_fft
+        fft_units = np.nonzero(pair_estimate > n_fft * np.log2(n_fft))[0]
+        sweep_index = np.where(np.isin(unit_index, fft_units), -1, unit_index)
 
-        self.acg = acg
+        # every other unit is counted in one parallel pass over the spikes instead of a histdiff per cluster
+        acg, _ = hf.spike_times_to_acg(spike_times, sweep_index, len(cluster_ids), acg_bins)
+        for unit in fft_units:
+            acg[unit], _ = hf.acg_fft(spike_times[unit_index == unit], acg_bins)
+
+        self.acg = acg.astype(np.float64)
 
     def _generate_sample_z_parameter(self) -> dict:
         """
@@ -822,17 +966,17 @@ class SpikeAnalysis:
         """
 
         import json
-        import glob
 
-        parameter_file = glob.glob("z_parameters.json")
+        # one stat of the file rather than a glob over the working directory
+        parameter_file = Path("z_parameters.json").is_file()
 
-        if len(parameter_file) == 0 and z_parameters is None:
+        if not parameter_file and z_parameters is None:
             raise Exception(
                 "There must be either json z parameter (run 'self._generate_sample_z_parameter' for example)\
                              or dict of response properties in same format "
             )
 
-        if len(parameter_file) > 0:
+        if parameter_file:
             with open("z_parameters.json") as read_file:
                 z_parameters = json.load(read_file)
         else:
@@ -843,57 +987,204 @@ class SpikeAnalysis:
         else:
             SAME_PARAMS = False
 
+        if SAME_PARAMS:
+            same_groups = _group_z_parameters(z_parameters["all"])
+        # stimuli binned the same way share the slices of a window
+        window_cache = {}
+
+        # every stimulus keeps one (n_keys, n_neurons, n_trials) array with the dictionary of each key as views into it
         self.responsive_neurons = {}
+        self.responsive_neurons_array = {}
+        self.responsive_key_index = {}
         for stim in self.z_scores.keys():
-            self.responsive_neurons[stim] = {}
             bins = self.z_bins[stim]
-            current_z_scores = self.z_scores[stim]
+            # z_score_data already gives float32, other z scores are compared at the same precision
+            current_z_scores = np.asarray(self.z_scores[stim]).astype(np.float32, copy=False)
 
             if SAME_PARAMS:
                 current_z_params = z_parameters["all"]
+                z_groups = same_groups
 
             else:
                 current_z_params = z_parameters[stim]
-
-            for key, value in current_z_params.items():
-                current_window = value["time"]
-                current_score = value["score"]
-                current_n_bins = value["n_bins"]
-                if len(current_window) == 2:
-                    window_index = np.logical_and(bins > current_window[0], bins < current_window[1])
-                elif len(current_window) == 4:
-                    window_index = np.logical_and(bins > current_window[0], bins < current_window[1]) | np.logical_and(
-                        bins > current_window[2], bins < current_window[3]
+                z_groups = _group_z_parameters(current_z_params)
+
+            key_index = {key: key_number for key_number, key in enumerate(current_z_params)}
+            stim_responsive_neurons = np.empty((len(key_index),) + np.shape(current_z_scores)[:2], dtype=bool)
+            for current_window, keys, current_scores, current_n_bins, inhibitory in z_groups:
+                cache_key = (bins.tobytes(), current_window)
+                if cache_key not in window_cache:
+                    window_cache[cache_key] = _window_slices(bins, current_window)
+
+                window_slices = window_cache[cache_key]
+                # one row per neuron and trial, a view for z scores from z_score_data
+                z_rows = current_z_scores.reshape(-1, np.shape(current_z_scores)[2])
+
+                # a row whose window never passes the loosest score of the group cannot pass any of them. With
+                # several keys on one window one pass over the extremes is cheaper than counting every key on
+                # every row, and on sparse responses it leaves few rows to count. fmax and fmin skip nan bins
+                # just as the comparisons below do
+                candidate_rows = slice(None)
+                if len(keys) > 1:
+                    candidates = np.zeros(len(z_rows), dtype=bool)
+                    for window_slice in window_slices:
+                        if np.any(~inhibitory):
+                            row_max = np.fmax.reduce(z_rows[:, window_slice], axis=1)
+                            candidates |= row_max > np.min(current_scores[~inhibitory])
+                        if np.any(inhibitory):
+                            row_min = np.fmin.reduce(z_rows[:, window_slice], axis=1)
+                            candidates |= row_min < np.max(current_scores[inhibitory])
+                    candidate_rows = np.flatnonzero(candidates)
+
+                # counting the boolean mask directly avoids an int64 copy of the whole window, and each part
+                # of the window is counted separately rather than joined
+                row_scores = current_scores[..., 0]
+                z_above_threshold = np.zeros((len(keys), len(z_rows)), dtype=np.int64)
+                candidate_counts = z_above_threshold[:, candidate_rows]
+                for window_slice in window_slices:
+                    current_z_scores_sub = z_rows[None, candidate_rows, window_slice]
+                    candidate_counts[~inhibitory] += np.count_nonzero(
+                        current_z_scores_sub > row_scores[~inhibitory], axis=2
                     )
-
-                else:
-                    raise Exception(
-                        f"Not implmented for window of size {len(current_window)} possible lengths are 2 or 4"
+                    candidate_counts[inhibitory] += np.count_nonzero(
+                        current_z_scores_sub < row_scores[inhibitory], axis=2
                     )
+                z_above_threshold[:, candidate_rows] = candidate_counts
+                z_above_threshold = z_above_threshold.reshape((len(keys),) + np.shape(current_z_scores)[:2])
 
-                current_z_scores_sub = current_z_scores[:, :, window_index]
-                if current_score > 0 or "inhib" not in key.lower():
-                    z_above_threshold = np.sum(np.where(current_z_scores_sub > current_score, 1, 0), axis=2)
-                else:
-                    z_above_threshold = np.sum(np.where(current_z_scores_sub < current_score, 1, 0), axis=2)
-
-                responsive_neurons = np.where(z_above_threshold > current_n_bins, True, False)
+                stim_responsive_neurons[[key_index[key] for key in keys]] = z_above_threshold > current_n_bins
 
-                self.responsive_neurons[stim][key] = responsive_neurons
+            self.responsive_neurons_array[stim] = stim_responsive_neurons
+            self.responsive_key_index[stim] = key_index
+            self.responsive_neurons[stim] = {key: stim_responsive_neurons[index] for key, index in key_index.items()}
 
     def save_responsive_neurons(self):
         import json
 
         file_path = self._file_path
 
+        # written one array at a time so the whole profile is never converted to python lists at once. The
+        # file is the same json that dumping the full dictionary gives
         with open(file_path / "response_profile.json", "w") as write_file:
-            json.dump(self.responsive_neurons, write_file, cls=NumpyEncoder)
+            write_file.write("{")
+            for stim_number, (stim, responses) in enumerate(self.responsive_neurons.items()):
+                write_file.write(f"{', ' if stim_number else ''}{json.dumps(stim)}: {{")
+                for key_number, (key, responsive_neurons) in enumerate(responses.items()):
+                    write_file.write(f"{', ' if key_number else ''}{json.dumps(key)}: ")
+                    json.dump(responsive_neurons, write_file, cls=NumpyEncoder)
+                write_file.write("}")
+            write_file.write("}")
 
     def _merge_events(self, event_0: dict, event_1: dict):
         """Utility function for merging digital and analog events into one dictionary"""
         events = {**event_0, **event_1}
         return events
 
+    def _event_set(self, channel: str) -> EventSet:
+        """
+        Utility function for accessing the events of a channel as an EventSet
+
+        Parameters
+        ----------
+        channel : str
+            The channel key into self.events
+
+        Returns
+        -------
+        event_set : EventSet
+            The events, lengths, trial groups and stimulus name of the channel
+
+        """
+        event_set = self.events[channel]
+        if not isinstance(event_set, EventSet):
+            # events assigned or updated as plain dicts are converted on first use
+            event_set = EventSet.from_dict(event_set)
+            self.events[channel] = event_set
+        return event_set
+
+    def _unit_index(self, spike_clusters: np.array) -> np.array:
+        """
+        Utility function for finding the row of each spike's cluster in cluster_ids
+
+        Parameters
+        ----------
+        spike_clusters : np.array
+            The cluster of each spike
+
+        Returns
+        -------
+        unit_index : np.array
+            The index into the sorted cluster_ids of each spike, -1 for clusters not being analyzed
+
+        """
+        cluster_ids = self.cluster_ids
+        position = np.minimum(np.searchsorted(cluster_ids, spike_clusters), len(cluster_ids) - 1)
+        return np.where(cluster_ids[position] == spike_clusters, position, -1)
+
+    def _rebinned(
+        self, stim: str, new_bin_number: int, windows: Optional[list[list]] = None
+    ) -> tuple[np.array, np.array]:
+        """
+        Utility function for sharing rebinned psths between the analysis methods
+
+        Parameters
+        ----------
+        stim : str
+            The stimulus to rebin the psth of
+        new_bin_number : int
+            The number of bins to convert the psth to
+        windows : Optional[list[list]], default None
+            The (start, end) windows which will be used. If the old bins divide evenly into the new ones
+            only the new bins from the first to the last one inside these windows are converted and returned,
+            with the bins cropped to match. By default every bin is converted
+
+        Returns
+        -------
+        psth : np.array
+            The rebinned psth, shared between calls so it should not be modified
+        bins : np.array
+            The bins of the rebinned psth
+
+        """
+        psth = self.psths[stim]["psth"]
+        n_bins = np.shape(psth)[2]
+        new_bins = hf.convert_bins(self.psths[stim]["bins"], new_bin_number)
+
+        first_bin, last_bin = 0, new_bin_number
+        if windows is not None and n_bins % new_bin_number == 0:
+            in_window = np.flatnonzero(
+                np.any([np.logical_and(new_bins >= start, new_bins <= end) for start, end in windows], axis=0)
+            )
+            if len(in_window) != 0:
+                first_bin, last_bin = in_window[0], in_window[-1] + 1
+                # callers take the bin size from the first two bins
+                if last_bin - first_bin < 2:
+                    first_bin = max(min(first_bin, new_bin_number - 2), 0)
+                    last_bin = min(first_bin + 2, new_bin_number)
+
+        # one rebinned psth is kept per stimulus and bin number, a new window range replaces it rather than piling
+        # up full size arrays over a session. The psth identity check catches psths which were replaced without
+        # running get_raw_psth
+        key = (stim, new_bin_number)
+        cached = self._rebin_cache.get(key)
+        if cached is None or cached[0] is not psth or not cached[2] <= first_bin < last_bin <= cached[3]:
+            if first_bin == 0 and last_bin == new_bin_number:
+                new_psth = hf.convert_to_new_bins(psth, new_bin_number)
+            else:
+                # each new bin is exactly bin_factor old bins so the cropped sums match the full conversion
+                bin_factor = n_bins // new_bin_number
+                new_psth = hf.convert_to_new_bins(
+                    psth[:, :, first_bin * bin_factor : last_bin * bin_factor], last_bin - first_bin
+                )
+            cached = (psth, new_psth, first_bin, last_bin)
+            self._rebin_cache[key] = cached
+
+        # only the converted bins are kept, a range inside a wider cached one is a view of it
+        new_psth = cached[1]
+        if (first_bin, last_bin) != cached[2:]:
+            new_psth = new_psth[:, :, first_bin - cached[2] : last_bin - cached[2]]
+        return new_psth, new_bins[first_bin:last_bin]
+
     def _get_key_for_stim(self) -> dict:
         """
         Utility function for helping to access correct value for get_raw_psth
@@ -906,7 +1197,7 @@ class SpikeAnalysis:
         """
         stim_dict = {}
         for channel in self.events.keys():
-            stim_name = self.events[channel]["stim"]
+            stim_name = self._event_set(channel).stim
             stim_dict[stim_name] = channel
 
         return stim_dict
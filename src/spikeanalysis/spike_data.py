@@ -58,7 +58,8 @@ class SpikeData:
         else:
             self.spike_clusters = self._spike_templates
 
-        self._cids = np.array(list(set(self.spike_clusters)))
+        # sorted so every array with a row per cluster shares the order of the qc metrics
+        self._cids = np.unique(self.spike_clusters)
 
         self.template_scaling_amplitudes = np.squeeze(np.load("amplitudes.npy"))
 
@@ -202,7 +203,8 @@ class SpikeData:
         else:
             self.spike_clusters = self._spike_templates
 
-        self._cids = np.array(list(set(self.spike_clusters)))
+        # sorted so every array with a row per cluster shares the order of the qc metrics
+        self._cids = np.unique(self.spike_clusters)
 
         self._return_to_dir(current_dir)
 
@@ -275,7 +277,7 @@ class SpikeData:
         # spike_clusters = self.spike_clusters
         # spike_templates = self._spike_templates
 
-        cluster_ids = list(set(spike_clusters))
+        cluster_ids = np.unique(spike_clusters)
         n_clusters = len(cluster_ids)
         n_spikes = len(spike_clusters)
         n_feat = np.min(np.array([8, np.shape(pc_features)[2]]))
@@ -60,7 +60,7 @@ def gaussian_smoothing(array: np.array, bin_size: float, std: float) -> np.array
     Parameters
     ----------
     array: np.array
-        The array to be smoothed
+        The array to be smoothed along its last axis
     bin_size: float
         The bin size to convert to firing rate units
     std: float
@@ -69,8 +69,8 @@ def gaussian_smoothing(array: np.array, bin_size: float, std: float) -> np.array
 
     gaussian_window = signal.windows.gaussian(round(std), (std - 1) / 6)
     smoothing_window = gaussian_window / np.sum(gaussian_window)
-    smoothed_array = np.zeros((np.shape(array)[0], np.shape(array)[1]))
-    for row in range(np.shape(array)[0]):
-        smoothed_array[row] = signal.convolve(array[row], smoothing_window, mode="same") / bin_size
+    # a window which is flat on the other axes lets one convolution smooth every row
+    smoothing_window = smoothing_window.reshape((1,) * (np.ndim(array) - 1) + (-1,))
+    smoothed_array = signal.convolve(array, smoothing_window, mode="same") / bin_size
 
     return smoothed_array
@@ -102,6 +102,44 @@ def test_spike_times_to_bins_failure():
     assert np.sum(bin_array) == 0
 
 
+def test_spike_times_to_unit_bins():
+    spike_times = np.array([1, 2, 2, 3, 4, 5, 7, 9], dtype=np.uint64)
+    unit_index = np.array([0, 1, 0, -1, 1, 0, 0, 1])
+    events = np.array([2, 4])
+
+    binned_array, bin_centers = hf.spike_times_to_unit_bins(spike_times, unit_index, 2, events, 1, -1, 3)
+    assert np.shape(binned_array) == (2, 2, 4)
+    for unit in range(2):
+        expected, expected_centers = hf.spike_times_to_bins(spike_times[unit_index == unit], events, 1, -1, 3)
+        np.testing.assert_array_equal(binned_array[unit], expected)
+    np.testing.assert_array_equal(bin_centers, expected_centers)
+
+
+def test_spike_times_to_acg():
+    spike_times = np.array([1, 2, 2, 3, 4, 5, 7, 9, 12, 13], dtype=np.uint64)
+    unit_index = np.array([0, 1, 0, -1, 1, 0, 0, 1, 0, 1])
+    bin_borders = np.linspace(1, 8, num=4, dtype=np.int32)
+
+    acg, bin_centers = hf.spike_times_to_acg(spike_times, unit_index, 2, bin_borders)
+    assert np.shape(acg) == (2, 3)
+    for unit in range(2):
+        unit_times = spike_times[unit_index == unit]
+        expected, expected_centers = hf.histdiff(unit_times, unit_times, bin_borders)
+        np.testing.assert_array_equal(acg[unit], expected)
+    np.testing.assert_array_equal(bin_centers, expected_centers)
+
+
+def test_acg_fft():
+    rng = np.random.default_rng(0)
+    spike_times = np.sort(rng.integers(100, 5000, size=400)).astype(np.uint64)
+    bin_borders = np.linspace(1, 150, num=75, dtype=np.int32)
+
+    acg, bin_centers = hf.acg_fft(spike_times, bin_borders)
+    expected, expected_centers = hf.spike_times_to_acg(spike_times, np.zeros(len(spike_times), int), 1, bin_borders)
+    np.testing.assert_array_equal(acg, expected[0])
+    np.testing.assert_array_equal(bin_centers, expected_centers)
+
+
 def test_hist_diff_simple_vector():
     test_array = np.array([1, 2, 3, 4, 5])
     ref_pt = np.array([1, 5])
@@ -283,3 +321,11 @@ def test_reg_hist():
     counts = hf.reghist(data1, ndata1, data2, ndata2, min_value, size, nbins, counts)
     print(counts)
     nptest.assert_array_equal(counts, np.array([2, 1, 0]))
+
+
+def test_window_indices():
+    time_stamps = np.array([1, 2, 4, 6, 8])
+    window_index, stamp_index = hf.window_indices(time_stamps, np.array([1, 0, 8]), np.array([6, 3, 9]))
+
+    np.testing.assert_array_equal(window_index, [0, 0, 1, 1])
+    np.testing.assert_array_equal(stamp_index, [1, 2, 0, 1])
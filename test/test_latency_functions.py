@@ -1,6 +1,7 @@
 from spikeanalysis.analysis_utils import latency_functions as lf
 
 import numpy as np
+import numpy.testing as nptest
 
 
 def test_latency_latency_core():
@@ -8,7 +9,8 @@ def test_latency_latency_core():
     test_array = np.expand_dims(test_array, axis=0)
     lat = lf.latency_core_stats(2, test_array, time_bin_size=0.0001)
     print(lat)
-    assert lat == [0.0002]
+    assert lat.dtype == np.float32
+    assert lat == [np.float32(0.0002)]
 
 
 def test_latency_core_nan():
@@ -51,7 +53,7 @@ def test_latency_median():
     test_array = np.expand_dims(test_array, axis=0)
     lat = lf.latency_median(test_array, time_bin_size=0.1)
     print(lat)
-    assert round(lat[0], 2) == 0.30
+    assert round(float(lat[0]), 2) == 0.30
 
     # nan test
     lat = lf.latency_median(test_array, time_bin_size=1)
@@ -75,3 +77,50 @@ def test_latency_nan():
     lat = lf.latency_median(test_array, time_bin_size=1)
     print(lat)
     assert np.isnan(lat)
+
+
+def test_latency_core_no_significant_bin():
+    test_array = np.zeros((2, 5))
+    lat = lf.latency_core_stats(10, test_array, time_bin_size=0.01)
+    assert np.isnan(lat).all()
+
+
+def test_latency_dispatch():
+    test_array = np.zeros((1, 10))
+    test_array[0, 2] = 1
+    nptest.assert_array_equal(lf.latency(1, test_array, 0.1), lf.latency_median(test_array, 0.1))
+
+    test_array = np.ones((1, 1000))
+    nptest.assert_array_equal(lf.latency(3, test_array, 0.0001), lf.latency_core_stats(3, test_array, 0.0001))
+
+
+def test_latency_units():
+    test_array = np.zeros((2, 1, 10))
+    test_array[0, 0, 2] = 1
+    test_array[1, 0, :] = 1
+    lat = lf.latency_units([1, 3], test_array, 0.1)
+
+    assert lat.shape == (2, 1)
+    nptest.assert_array_equal(lat[0], lf.latency(1, test_array[0], 0.1))
+    nptest.assert_array_equal(lat[1], lf.latency(3, test_array[1], 0.1))
+
+
+def test_latency_core_tol():
+    test_array = np.zeros((1, 10))
+    test_array[0, 2] = 1
+    # one spike at a 1 Hz baseline is only significant for a loose tolerance
+    assert np.isnan(lf.latency_core_stats(1, test_array, 0.01)[0])
+    nptest.assert_array_equal(lf.latency_core_stats(1, test_array, 0.01, tol=0.05), [np.float32(0.03)])
+
+
+def test_latency_shuffled():
+    test_array = np.zeros((2, 20))
+    test_array[0, 5:] = 1
+    test_array[1, 12] = 1
+    start_bins = np.array([0, 4, 10])
+
+    for bsl_fr in [1, 3]:
+        lat = lf.latency_shuffled(bsl_fr, test_array, start_bins, 0.01)
+        assert lat.shape == (2, 3)
+        for shuffle, start in enumerate(start_bins):
+            nptest.assert_array_equal(lat[:, shuffle], lf.latency(bsl_fr, test_array[:, start:], 0.01))
@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 import numpy.testing as nptest
 import os
@@ -6,7 +7,8 @@ from pathlib import Path
 
 from spikeanalysis.stimulus_data import StimulusData
 from spikeanalysis.spike_data import SpikeData
-from spikeanalysis.spike_analysis import SpikeAnalysis
+from spikeanalysis.spike_analysis import SpikeAnalysis, EventSet, _window_slices
+from spikeanalysis.curated_spike_analysis import read_responsive_neurons
 
 
 @pytest.fixture(scope="module")
@@ -33,6 +35,13 @@ def test_attributes_sa(sa):
     assert len(sa.raw_spike_times) == 10
 
 
+def test_unit_index(sa):
+    assert np.all(np.diff(sa.cluster_ids) > 0)
+    unit_index = sa._unit_index(sa.spike_clusters)
+    nptest.assert_array_equal(sa.cluster_ids[unit_index], sa.spike_clusters)
+    assert sa._unit_index(np.array([np.max(sa.cluster_ids) + 1]))[0] == -1
+
+
 def test_merge_dicts(sa):
     dict1 = {1: {"a": [1, 2, 3]}}
     dict2 = {2: {"b": [4, 5, 6]}}
@@ -47,6 +56,17 @@ def test_merge_dicts(sa):
         assert isinstance(value, dict)
 
 
+def test_event_set(sa):
+    sa.events = {"0": {"events": [100, 200], "lengths": [100, 100], "trial_groups": [1, 2], "stim": "test"}}
+    event_set = sa._event_set("0")
+
+    assert isinstance(event_set, EventSet)
+    assert sa.events["0"] is event_set, "converted event set should be stored"
+    nptest.assert_array_equal(event_set.events, np.array([100, 200]))
+    nptest.assert_array_equal(event_set["trial_groups"], event_set.trial_groups)
+    assert event_set["stim"] == "test"
+
+
 @pytest.fixture(scope="module")
 def sa_mocked(sa):
     sa.events = {
@@ -92,18 +112,52 @@ def test_fr_data(sa):
 
     assert sa.mean_firing_rate["test"][0, 0, 0] == 0.5
     assert sa.mean_firing_rate["test"][1, 0, 2] == 1.0
+    assert sa.mean_firing_rate["test"].dtype == np.float32
 
     sa.get_raw_firing_rate(time_bin_ms=1000, bsl_window=[0, 50], fr_window=[0, 300], mode="bsl-subtracted")
 
     print(sa.mean_firing_rate)
-    assert round(sa.mean_firing_rate["test"][0, 0, 0], 2) == 0.42
-    assert round(sa.mean_firing_rate["test"][1, 0, 2], 2) == 0.9
+    assert round(float(sa.mean_firing_rate["test"][0, 0, 0]), 2) == 0.42
+    assert round(float(sa.mean_firing_rate["test"][1, 0, 2]), 2) == 0.9
 
     sa.get_raw_firing_rate(time_bin_ms=1000, bsl_window=None, fr_window=[0, 300], mode="smooth", sm_time_ms=0.5)
 
     print(sa.mean_firing_rate)
-    assert round(sa.mean_firing_rate["test"][0, 0, 0], 2) == round(0.5, 2)
-    assert round(sa.mean_firing_rate["test"][1, 0, 2], 2) == 1.0
+    assert round(float(sa.mean_firing_rate["test"][0, 0, 0]), 2) == round(0.5, 2)
+    assert round(float(sa.mean_firing_rate["test"][1, 0, 2]), 2) == 1.0
+
+
+def test_rebinned_cache(sa):
+    sa.events = {
+        "0": {
+            "events": np.array([100, 200]),
+            "lengths": np.array([100, 100]),
+            "trial_groups": np.array([1, 1]),
+            "stim": "test",
+        }
+    }
+    sa.get_raw_psth(window=[0, 300], time_bin_ms=50)
+    psth, bins = sa._rebinned("test", 300)
+    assert np.shape(psth) == (2, 2, 300)
+    assert sa._rebinned("test", 300)[0] is psth
+
+    # a range inside the cached one is a view of it
+    cropped_psth, cropped_bins = sa._rebinned("test", 300, [[10, 20]])
+    in_window = np.logical_and(bins >= 10, bins <= 20)
+    nptest.assert_array_equal(cropped_bins, bins[in_window])
+    nptest.assert_array_equal(cropped_psth, psth[:, :, in_window])
+    assert np.shares_memory(cropped_psth, psth)
+
+    # a new range only converts and keeps its own bins
+    sa.get_raw_psth(window=[0, 300], time_bin_ms=50)
+    cropped_psth, cropped_bins = sa._rebinned("test", 300, [[10, 20]])
+    nptest.assert_array_equal(cropped_bins, bins[in_window])
+    nptest.assert_array_equal(cropped_psth, psth[:, :, in_window])
+    assert np.shape(sa._rebin_cache[("test", 300)][1]) == np.shape(cropped_psth)
+    assert len(sa._rebin_cache) == 1, "a new window should replace the cached psth of the same bin number"
+
+    sa.get_raw_psth(window=[0, 300], time_bin_ms=50)
+    assert sa._rebinned("test", 300)[0] is not psth
 
 
 def test_z_score_data(sa):
@@ -225,6 +279,32 @@ def test_trial_correlation(sa):
     nptest.assert_allclose(sa.correlations["test"], np.array([[0.24849699], [0.59899749]]))
 
 
+def test_trial_correlation_n_jobs(sa):
+    # use a copy so the second stimulus does not leak into the psths of the later tests
+    sa = copy.copy(sa)
+    sa.events = {
+        "0": {
+            "events": np.array([100, 200]),
+            "lengths": np.array([100, 100]),
+            "trial_groups": np.array([1, 1]),
+            "stim": "test",
+        },
+        "1": {
+            "events": np.array([100, 300]),
+            "lengths": np.array([100, 100]),
+            "trial_groups": np.array([1, 1]),
+            "stim": "test2",
+        },
+    }
+    sa.get_raw_psth(window=[0, 300], time_bin_ms=50)
+    sa.trial_correlation(window=[0, 100], time_bin_ms=50)
+    serial_correlations = sa.correlations
+    sa.trial_correlation(window=[0, 100], time_bin_ms=50, n_jobs=2)
+
+    for stim in ("test", "test2"):
+        nptest.assert_array_equal(sa.correlations[stim], serial_correlations[stim])
+
+
 def test_generate_z_scores(sa, tmp_path):
     os.chdir(tmp_path)
     sample_z = sa._generate_sample_z_parameter()
@@ -259,6 +339,21 @@ def test_get_key_for_stim(sa):
 
     assert stim_dict[stim_name] == channel, "getting key failed."
 
+    sa.events.update({"DIG-IN-02": {"stim": "test2"}})
+    assert sa._get_key_for_stim() == {"test": "DIG-IN-01", "test2": "DIG-IN-02"}, "in place update should be seen"
+
+    sa.events = {"DIG-IN-01": {"stim": "new"}}
+    assert sa._get_key_for_stim() == {"new": "DIG-IN-01"}, "reassigned events should be seen"
+
+
+def test_window_slices():
+    bins = np.linspace(0, 1, 11)
+
+    assert _window_slices(bins, [0.15, 0.45]) == [slice(2, 5)]
+    assert _window_slices(bins, [0.15, 0.45, 0.65, 1.0]) == [slice(2, 5), slice(7, 10)]
+    assert _window_slices(bins, [0.15, 0.45, 0.35, 0.85]) == [slice(2, 9)], "overlapping windows should be merged"
+    assert _window_slices(bins, [0.45, 0.45]) == []
+
 
 def test_failed_responsive_neurons(sa, tmp_path):
     os.chdir(tmp_path)
@@ -292,6 +387,11 @@ def test_responsive_neurons(sa):
     for key in resp_neurons["test"].keys():
         assert key in sample_keys, "should return boolean for each key"
 
+    resp_array = sa.responsive_neurons_array["test"]
+    assert np.shape(resp_array) == (len(resp_neurons["test"]), 4, 3)
+    for key, index in sa.responsive_key_index["test"].items():
+        nptest.assert_array_equal(resp_array[index], resp_neurons["test"][key])
+
     print(resp_neurons["test"]["onset"])
     assert resp_neurons["test"]["onset"][0, 0]
     assert resp_neurons["test"]["onset"][0, 1] == False
@@ -335,6 +435,10 @@ def test_write_responsive_neurons(sa, tmp_path):
 
     assert have_json, "file not written"
 
+    curation = read_responsive_neurons(sa._file_path)
+    for key, responsive_neurons in sa.responsive_neurons["test"].items():
+        nptest.assert_array_equal(curation["test"][key], responsive_neurons)
+
     sa._file_path = file_path
     os.chdir(sa._file_path)
 
@@ -358,6 +462,39 @@ def test_latencies(sa):
     assert np.shape(sa.latency["test"]["latency"]) == (2, 2)
     assert np.shape(sa.latency["test"]["latency_shuffled"]) == (2, 2, 300)
 
+    sa.latencies(bsl_window=[-1, 0], seed=42)
+    first_shuffled = sa.latency["test"]["latency_shuffled"]
+    sa.latencies(bsl_window=[-1, 0], seed=42)
+    nptest.assert_array_equal(first_shuffled, sa.latency["test"]["latency_shuffled"])
+
+
+def test_latencies_post_stimulus_baseline():
+    sa = SpikeAnalysis()
+    sa.NUM_STIM = 1
+    sa.events = {
+        "0": {
+            "events": np.arange(4) * 3000,
+            "lengths": np.full(4, 100),
+            "trial_groups": np.ones(4),
+            "stim": "burst",
+        }
+    }
+    psth = np.zeros((1, 4, 2000), dtype=np.int32)
+    psth[:, :, 530:540] = 5  # burst 30-40 ms after each event
+    psth[:, :, 1000:1500:100] = 1  # sparse firing in the baseline
+    sa.psths = {"burst": {"psth": psth, "bins": np.linspace(-0.5, 1.5, num=2001)[:-1]}}
+
+    # the baseline starts after the response so the response bins must still be rebinned
+    sa.latencies(bsl_window=[0.5, 1.0], time_bin_ms=10)
+
+    latency = sa.latency["burst"]["latency"]
+    assert np.all(np.isfinite(latency))
+    assert np.all((latency >= 30) & (latency <= 50))
+
+    # a stricter threshold can only move the latency later
+    sa.latencies(bsl_window=[0.5, 1.0], time_bin_ms=10, tol=1e-12)
+    assert np.all(sa.latency["burst"]["latency"] >= latency)
+
 
 def test_autocorrelogram(sa):
     print(sa.raw_spike_times)
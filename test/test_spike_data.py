@@ -30,6 +30,7 @@ def test_SpikeData_attributes(spikes):
 
     assert np.shape(spikes.x_coords) == (4,), "channel map incorrectly read"
     assert len(spikes._cids) == 2, "cids not loaded correctly"
+    assert np.all(np.diff(spikes._cids) > 0), "cids should be sorted"
 
 
 def test_samples_to_seconds(spikes):
@@ -54,6 +54,17 @@ def test_gaussian_smoothing_with_std():
     assert np.min(more_sm_array) > np.min(sm_array), "Extra smoothing should raise the trough"
 
 
+def test_gaussian_smoothing_3d():
+    test_array = np.array([[0, 1, 2, 1, 0], [0, 2, 10, 4, 0]])
+    stacked_array = np.stack([test_array, 2 * test_array])
+
+    sm_array = gaussian_smoothing(stacked_array, 1, 3)
+
+    assert np.shape(sm_array) == (2, 2, 5)
+    assert np.allclose(sm_array[0], gaussian_smoothing(test_array, 1, 3))
+    assert np.allclose(sm_array[1], gaussian_smoothing(2 * test_array, 1, 3))
+
+
 def test_gaussian_smoothing_with_time():
     test_array = np.array([[0, 1, 2, 1, 0], [0, 2, 10, 4, 0]])
 